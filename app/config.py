@@ -16,13 +16,37 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-import datetime
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
+
+DEBUG_LOG_FILE = "debug_output.txt"
+
+# Application logger: records are handed to a queue and written to the debug log
+# by a QueueListener thread, so callers never touch the file themselves.
+# Warnings and errors are also echoed to the console.
+logger = logging.getLogger("app")
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
+# In production the service modules (app.services.*) only report warnings and errors;
+# log_debug output from the app itself is always kept.
+if os.getenv("ENV") == "prod":
+    logging.getLogger("app.services").setLevel(logging.WARNING)
+
+_log_queue = queue.SimpleQueue()
+_file_handler = logging.FileHandler(DEBUG_LOG_FILE, encoding="utf-8", delay=True)
+_file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+_console_handler = logging.StreamHandler()
+_console_handler.setLevel(logging.WARNING)
+_console_handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+
+log_listener = logging.handlers.QueueListener(_log_queue, _file_handler, _console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 def log_debug(msg):
-    try:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open("debug_output.txt", "a", encoding="utf-8") as f:
-            f.write(f"[{timestamp}] {msg}\n")
-    except Exception as e:
-        print(f"Logging failed: {e}")
+    logger.debug(msg)
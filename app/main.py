@@ -5,15 +5,19 @@ from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 import os
 import shutil
 import socket
-import json
+import orjson
 import asyncio
+import bisect
+import random
+import secrets
 from datetime import datetime, timedelta
 
 from app.services.google_sheets import GoogleSheetService
 from app.services.qr_generator import QRGenerator
 from app.services.whatsapp import whatsapp_service
 from app.services.crypto import crypto_service
-from app.config import settings
+from app.services.storage import record_path, write_json_atomic, load_json_dir, file_writer
+from app.config import settings, log_debug
 
 app = FastAPI()
 
@@ -27,55 +31,92 @@ templates = Jinja2Templates(directory="templates")
 qr_generator = QRGenerator()
 google_sheet_service = GoogleSheetService()
 
+_local_ip = None
+
 def get_local_ip():
+    # The routing IP does not change while the server runs, so a successful lookup is reused.
+    # The localhost fallback is not cached, so a later call can still find the network.
+    global _local_ip
+    if _local_ip is not None:
+        return _local_ip
     try:
         # Connect to a public DNS to determine local IP used for routing
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
+        _local_ip = s.getsockname()[0]
         s.close()
-        return local_ip
+        return _local_ip
     except Exception:
         return "127.0.0.1"
 
+# Ticket plans: selection value -> (amount, duration in minutes, plan name)
+PLANS = {
+    "premium_50": (50, 15, "Premium"),
+    "standard_40": (40, 15, "Standard"),
+}
+UNKNOWN_PLAN = (0, 0, "Unknown")
+
 # Global state for active sessions
 active_sessions = {}
-SESSION_FILE = "sessions.json"
+# (end_time, transaction_id) pairs kept sorted, so the next session to end is always first
+ending_soon = []
+SESSIONS_DIR = "data/sessions"
+SESSION_FILE = "sessions.json" # Legacy single-file store, migrated on load
 STATE_FILE = "server_state.json"
 
-def save_sessions():
-    """Saves active sessions to JSON file."""
+def track_session_end(tid: str, end_time: datetime):
+    bisect.insort(ending_soon, (end_time, tid))
+
+def untrack_session_end(tid: str, end_time: datetime):
+    i = bisect.bisect_left(ending_soon, (end_time, tid))
+    if i < len(ending_soon) and ending_soon[i] == (end_time, tid):
+        del ending_soon[i]
+
+def format_session_times(session: dict):
+    """Caches the formatted start/end times so polling and saving do not re-format them."""
+    session["start_time_hms"] = session["start_time"].strftime("%H:%M:%S")
+    session["end_time_hms"] = session["end_time"].strftime("%H:%M:%S")
+    session["start_iso"] = session["start_time"].isoformat()
+    session["end_iso"] = session["end_time"].isoformat()
+
+def save_one_session(tid: str, session: dict):
+    """Saves a single active session to its own file."""
     try:
-        data = {}
-        for tid, session in active_sessions.items():
-            data[tid] = {
-                "name": session["name"],
-                "phone": session["phone"],
-                "transaction_id": session["transaction_id"],
-                "duration": session["duration"],
-                "start_time": session["start_time"].isoformat(),
-                "end_time": session["end_time"].isoformat(),
-                "restore_key": session.get("restore_key") # Save restore key
-            }
-        with open(SESSION_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-        print("Sessions saved to disk.")
+        data = {
+            "name": session["name"],
+            "phone": session["phone"],
+            "transaction_id": session["transaction_id"],
+            "duration": session["duration"],
+            "start_time": session["start_iso"],
+            "end_time": session["end_iso"],
+            "restore_key": session.get("restore_key") # Save restore key
+        }
+        file_writer.write_json(record_path(SESSIONS_DIR, tid), data)
     except Exception as e:
-        print(f"Failed to save sessions: {e}")
+        print(f"Failed to save session {tid}: {e}")
+
+def delete_one_session(tid: str):
+    """Removes the file of an ended session."""
+    try:
+        file_writer.delete(record_path(SESSIONS_DIR, tid))
+    except Exception as e:
+        print(f"Failed to delete session {tid}: {e}")
 
 def load_sessions():
-    """Loads sessions from JSON file."""
+    """Loads sessions from the sessions directory."""
     global active_sessions
     try:
-        import os
-        if not os.path.exists(SESSION_FILE):
-            return
-
-        with open(SESSION_FILE, "r") as f:
-            data = json.load(f)
-            
-        for tid, session in data.items():
-            active_sessions[tid] = {
+        # Migrate the legacy single-file store to one file per session
+        if os.path.exists(SESSION_FILE):
+            with open(SESSION_FILE, "rb") as f:
+                legacy = orjson.loads(f.read())
+            for tid, session in legacy.items():
+                write_json_atomic(record_path(SESSIONS_DIR, tid), session)
+            os.replace(SESSION_FILE, SESSION_FILE + ".migrated")
+            print(f"Migrated {len(legacy)} sessions from {SESSION_FILE}.")
+
+        for session in load_json_dir(SESSIONS_DIR):
+            active_sessions[session["transaction_id"]] = {
                 "name": session["name"],
                 "phone": session["phone"],
                 "transaction_id": session["transaction_id"],
@@ -84,6 +125,8 @@ def load_sessions():
                 "end_time": datetime.fromisoformat(session["end_time"]),
                 "restore_key": session.get("restore_key") # Load restore key
             }
+            format_session_times(active_sessions[session["transaction_id"]])
+            track_session_end(session["transaction_id"], active_sessions[session["transaction_id"]]["end_time"])
         print(f"Loaded {len(active_sessions)} sessions from disk.")
     except Exception as e:
         print(f"Failed to load sessions: {e}")
@@ -91,16 +134,15 @@ def load_sessions():
 def load_server_state():
     try:
         if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r") as f:
-                return json.load(f)
+            with open(STATE_FILE, "rb") as f:
+                return orjson.loads(f.read())
     except Exception as e:
         print(f"Error loading server state: {e}")
     return {}
 
 def save_server_state(data):
     try:
-        with open(STATE_FILE, "w") as f:
-            json.dump(data, f, indent=4)
+        file_writer.write_json(STATE_FILE, data)
     except Exception as e:
         print(f"Error saving server state: {e}")
 
@@ -122,19 +164,21 @@ async def startup_event():
     
     # Cleanup expired sessions
     now = datetime.now()
-    initial_count = len(active_sessions)
-    active_sessions = {
-        tid: session 
-        for tid, session in active_sessions.items() 
-        if session["end_time"] > now
-    }
+    expired_count = 0
+    while ending_soon and ending_soon[0][0] <= now:
+        _, tid = ending_soon.pop(0)
+        del active_sessions[tid]
+        delete_one_session(tid)
+        expired_count += 1
     
-    if len(active_sessions) < initial_count:
-        print(f"Cleaned up {initial_count - len(active_sessions)} expired sessions on startup.")
-        save_sessions()
+    if expired_count:
+        print(f"Cleaned up {expired_count} expired sessions on startup.")
 
     # Start Hourly Stats Task
     asyncio.create_task(hourly_stats_task())
+
+    # Start Error Alert Worker
+    asyncio.create_task(alert_worker())
     
     # Restore timers for active sessions
     now = datetime.now()
@@ -146,6 +190,13 @@ async def startup_event():
             print(f"Restoring timer for {session['name']} ({remaining_minutes:.2f} mins left)")
             asyncio.create_task(session_timer_task(session["phone"], session["duration"], tid, is_resume=True, resume_seconds=remaining_seconds))
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Make sure queued session/key writes reach the disk before exiting
+    file_writer.flush()
+    # Send any rows still waiting in the Google Sheets append buffer
+    google_sheet_service.flush_appends()
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -178,7 +229,6 @@ async def submit_entry(
                  )
     else:
         # Generate Cash Transaction ID
-        import random
         # Format: CASH-YYYYMMDD-HHMMSS-XXX
         timestamp_part = datetime.now().strftime("%Y%m%d-%H%M%S")
         random_part = str(random.randint(100, 999))
@@ -260,7 +310,7 @@ async def verify_entry(request: Request, token: str):
         
         # Send WhatsApp Message
         msg = f"Welcome {name}! Your entry is confirmed. Please ask the admin to start your {duration} mins session."
-        whatsapp_service.send_message(phone, msg)
+        await whatsapp_service.asend_message(phone, msg)
         
         return templates.TemplateResponse("scan_result.html", {
             "request": request,
@@ -282,55 +332,51 @@ async def verify_entry(request: Request, token: str):
         })
 
 # Global state for pending keys (Security)
-PENDING_KEYS_FILE = "pending_keys.json"
+PENDING_KEYS_DIR = "data/pending_keys"
+PENDING_KEYS_FILE = "pending_keys.json" # Legacy single-file store, migrated on load
 pending_keys = {}
 
 def load_pending_keys():
-    """Loads pending keys from JSON file."""
+    """Loads pending keys from the pending keys directory."""
     global pending_keys
     try:
+        # Migrate the legacy single-file store to one file per key
         if os.path.exists(PENDING_KEYS_FILE):
-            with open(PENDING_KEYS_FILE, "r") as f:
-                pending_keys = json.load(f)
+            with open(PENDING_KEYS_FILE, "rb") as f:
+                legacy = orjson.loads(f.read())
+            for tid, secure_key in legacy.items():
+                write_json_atomic(record_path(PENDING_KEYS_DIR, tid), {"transaction_id": tid, "secure_key": secure_key})
+            os.replace(PENDING_KEYS_FILE, PENDING_KEYS_FILE + ".migrated")
+            print(f"Migrated {len(legacy)} pending keys from {PENDING_KEYS_FILE}.")
+
+        for record in load_json_dir(PENDING_KEYS_DIR):
+            pending_keys[record["transaction_id"]] = record["secure_key"]
         print(f"Loaded {len(pending_keys)} pending keys.")
     except Exception as e:
         print(f"Failed to load pending keys: {e}")
 
-def save_pending_keys():
-    """Saves pending keys to JSON file."""
+def save_pending_key(tid: str, secure_key: str):
+    """Saves a single pending key to its own file."""
     try:
-        with open(PENDING_KEYS_FILE, "w") as f:
-            json.dump(pending_keys, f, indent=4)
+        file_writer.write_json(record_path(PENDING_KEYS_DIR, tid), {"transaction_id": tid, "secure_key": secure_key})
     except Exception as e:
-        print(f"Failed to save pending keys: {e}")
+        print(f"Failed to save pending key {tid}: {e}")
+
+def delete_pending_key(tid: str):
+    """Removes the file of a used pending key."""
+    try:
+        file_writer.delete(record_path(PENDING_KEYS_DIR, tid))
+    except Exception as e:
+        print(f"Failed to delete pending key {tid}: {e}")
 
 # Load keys on startup
 load_pending_keys()
 
 def process_entry_task(name: str, phone: str, transaction_id: str, plan_selection: str, payment_mode: str):
-    from app.config import log_debug
-    import secrets
     log_debug(f"Starting task for: {name}, {phone}, {transaction_id}, {plan_selection}, {payment_mode}")
     
     # Parse Plan
-    try:
-        if plan_selection == "premium_50":
-            amount = 50
-            duration = 15
-            plan_name = "Premium"
-        elif plan_selection == "standard_40":
-            amount = 40
-            duration = 15
-            plan_name = "Standard"
-        else:
-            # Fallback or Error
-            amount = 0
-            duration = 0
-            plan_name = "Unknown"
-    except Exception:
-        amount = 0
-        duration = 0
-        plan_name = "Error"
+    amount, duration, plan_name = PLANS.get(plan_selection, UNKNOWN_PLAN)
     
     # 1. Clean Phone
     phone = phone.replace(" ", "").replace("-", "").replace("+", "")
@@ -340,7 +386,7 @@ def process_entry_task(name: str, phone: str, transaction_id: str, plan_selectio
     
     # Store key
     pending_keys[transaction_id] = secure_key
-    save_pending_keys()
+    save_pending_key(transaction_id, secure_key)
     
     # 3. Generate QR Data (Encrypted Token with Key)
     data = {
@@ -389,37 +435,36 @@ def process_entry_task(name: str, phone: str, transaction_id: str, plan_selectio
     # 6. Send Message via WhatsApp
     caption = f"Hello {name}, your {payment_mode} transaction ({transaction_id}) for {plan_name} - INR {amount} ({duration} mins) is confirmed. Here is your unique QR code."
     
-    try:
-        log_debug(f"Attempting to send QR to {phone}")
-        success = whatsapp_service.send_image(phone, qr_path, caption)
-        if success:
-            log_debug(f"Sent QR to {name} ({phone})")
-        else:
-            log_debug(f"Failed to send QR to {name} ({phone})")
-    except Exception as e:
-        log_debug(f"Error sending WhatsApp message: {e}")
+    def on_sent(future):
+        try:
+            if future.result():
+                log_debug(f"Sent QR to {name} ({phone})")
+            else:
+                log_debug(f"Failed to send QR to {name} ({phone})")
+        except Exception as e:
+            log_debug(f"Error sending WhatsApp message: {e}")
+
+    log_debug(f"Attempting to send QR to {phone}")
+    # Returns immediately; the send completes on the WhatsApp service's threads
+    whatsapp_service.send_image(phone, qr_path, caption).add_done_callback(on_sent)
 
 async def hourly_stats_task():
     """Background task to send hourly statistics (Persistent)."""
     print("Starting Hourly Stats Task...")
     
+    # The schedule is read from disk once; afterwards it is only written after each report
+    last_report_str = load_server_state().get("last_hourly_report")
+    if last_report_str:
+        next_report_time = datetime.fromisoformat(last_report_str) + timedelta(hours=1)
+    else:
+        now = datetime.now()
+        save_server_state({"last_hourly_report": now})
+        next_report_time = now + timedelta(hours=1)
+    
     while True:
         try:
-            state = load_server_state()
-            last_report_str = state.get("last_hourly_report")
-            
-            now = datetime.now()
-            
-            if last_report_str:
-                last_report_time = datetime.fromisoformat(last_report_str)
-                next_report_time = last_report_time + timedelta(hours=1)
-                wait_seconds = (next_report_time - now).total_seconds()
-            else:
-                last_report_time = now
-                save_server_state({"last_hourly_report": now.isoformat()})
-                wait_seconds = 3600
-            
-            print(f"Hourly Stats: Last run {last_report_time}, Next run in {wait_seconds:.2f}s")
+            wait_seconds = (next_report_time - datetime.now()).total_seconds()
+            print(f"Hourly Stats: Next run at {next_report_time}, in {wait_seconds:.2f}s")
             
             if wait_seconds > 0:
                 await asyncio.sleep(wait_seconds)
@@ -435,27 +480,40 @@ async def hourly_stats_task():
             )
             
             print(f"Sending Hourly Report: {msg}")
-            whatsapp_service.send_message(settings.ADMIN_PHONE, msg)
+            await whatsapp_service.asend_message(settings.ADMIN_PHONE, msg)
             
             # --- Update State ---
-            new_now = datetime.now()
-            save_server_state({"last_hourly_report": new_now.isoformat()})
-            
-            await asyncio.sleep(1) 
+            report_time = datetime.now()
+            save_server_state({"last_hourly_report": report_time})
+            next_report_time = report_time + timedelta(hours=1)
             
         except Exception as e:
             print(f"Error in hourly stats task: {e}")
             await asyncio.sleep(60)
 
+# Error alerts for the admin, sent by alert_worker so the error response is never held up
+alert_queue = asyncio.Queue(maxsize=1024)
+
+async def alert_worker():
+    """Background task that delivers queued error alerts via WhatsApp."""
+    while True:
+        error_msg = await alert_queue.get()
+        try:
+            await whatsapp_service.asend_message(settings.ADMIN_PHONE, error_msg)
+        except Exception as e:
+            print(f"Failed to send error alert: {e}")
+        finally:
+            alert_queue.task_done()
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     error_msg = f"Server Error\nPath: {request.url.path}\nError: {str(exc)}"
     print(error_msg)
     
     try:
-        whatsapp_service.send_message(settings.ADMIN_PHONE, error_msg)
-    except Exception as e:
-        print(f"Failed to send error alert: {e}")
+        alert_queue.put_nowait(error_msg)
+    except asyncio.QueueFull:
+        print("Error alert queue is full, dropping alert.")
         
     return JSONResponse(
         status_code=500,
@@ -480,36 +538,38 @@ async def start_timer(
     except ValueError:
         duration_int = 15 
 
+    # Generate Restore Key
+    restore_key = secrets.token_urlsafe(12) # approx 16 chars
+
     # Store session info
     start_time = datetime.now()
     end_time = start_time + timedelta(minutes=duration_int)
     
+    if transaction_id in active_sessions:
+        untrack_session_end(transaction_id, active_sessions[transaction_id]["end_time"])
     active_sessions[transaction_id] = {
         "name": name,
         "phone": phone,
         "transaction_id": transaction_id,
         "duration": duration_int,
         "start_time": start_time,
-        "end_time": end_time
+        "end_time": end_time,
+        "restore_key": restore_key
     }
+    format_session_times(active_sessions[transaction_id])
     
-    save_sessions()
+    track_session_end(transaction_id, end_time)
+    save_one_session(transaction_id, active_sessions[transaction_id])
 
     # Remove Secure Key (Now it is truly used)
     if transaction_id in pending_keys:
         del pending_keys[transaction_id]
-        save_pending_keys()
-
-    # Generate Restore Key
-    import secrets
-    restore_key = secrets.token_urlsafe(12) # approx 16 chars
-    active_sessions[transaction_id]["restore_key"] = restore_key
-    save_sessions()
+        delete_pending_key(transaction_id)
 
     background_tasks.add_task(session_timer_task, phone, duration_int, transaction_id)
     return {
         "status": "Timer started",
-        "end_time": end_time.isoformat(),
+        "end_time": active_sessions[transaction_id]["end_iso"],
         "duration": duration_int,
         "restore_key": restore_key
     }
@@ -529,9 +589,9 @@ async def verify_restore(request: Request):
             if session.get("restore_key") == restore_key:
                 return {
                     "status": "restored",
-                    "end_time": session["end_time"].isoformat(),
+                    "end_time": session["end_iso"],
                     "duration": session["duration"],
-                    "start_time": session["start_time"].isoformat()
+                    "start_time": session["start_iso"]
                 }
         
         return JSONResponse(status_code=403, content={"status": "error", "message": "Invalid Restore Key or Session Ended"})
@@ -608,8 +668,10 @@ async def get_sessions():
     now = datetime.now()
     sessions_list = []
     
-    for tid, session in active_sessions.items():
-        remaining = (session["end_time"] - now).total_seconds()
+    # Sessions are listed in the order they end
+    for end_time, tid in ending_soon:
+        session = active_sessions[tid]
+        remaining = (end_time - now).total_seconds()
         status = "Active"
         if remaining <= 0:
             remaining = 0
@@ -622,8 +684,8 @@ async def get_sessions():
             "phone": session["phone"],
             "transaction_id": session["transaction_id"],
             "duration": session["duration"],
-            "start_time": session["start_time"].strftime("%H:%M:%S"),
-            "end_time": session["end_time"].strftime("%H:%M:%S"),
+            "start_time": session["start_time_hms"],
+            "end_time": session["end_time_hms"],
             "remaining_seconds": int(remaining),
             "status": status
         })
@@ -631,12 +693,9 @@ async def get_sessions():
     return sessions_list
 
 async def session_timer_task(phone: str, duration: int, transaction_id: str, is_resume: bool = False, resume_seconds: float = None):
-    from app.config import log_debug
     # Global variables for session management
     global active_sessions
     
-    loop = asyncio.get_event_loop()
-    
     try:
         log_debug(f"Timer task START: {phone}, {duration}m, resume={is_resume}, remaining={resume_seconds}")
         
@@ -644,8 +703,8 @@ async def session_timer_task(phone: str, duration: int, transaction_id: str, is_
             try:
                 msg = f"Your {duration} minutes session has STARTED now. Have fun!"
                 log_debug(f"Sending start msg to {phone}")
-                # Use executor to avoid blocking async loop since send_message might sleep/wait
-                await loop.run_in_executor(None, whatsapp_service.send_message, phone, msg)
+                # send_message might sleep/wait, so it runs on the WhatsApp service's own threads
+                await whatsapp_service.asend_message(phone, msg)
                 log_debug(f"Start msg sent to {phone}")
             except Exception as e:
                 log_debug(f"Failed to send start message: {e}")
@@ -674,7 +733,7 @@ async def session_timer_task(phone: str, duration: int, transaction_id: str, is_
             try:
                 msg = f"Warning: You have {warning_buffer_mins} minutes remaining in your session."
                 log_debug(f"Sending warning to {phone}")
-                await loop.run_in_executor(None, whatsapp_service.send_message, phone, msg)
+                await whatsapp_service.asend_message(phone, msg)
                 log_debug(f"Sent warning to {phone}")
             except Exception as e:
                 log_debug(f"Failed to send warning: {e}")
@@ -702,13 +761,14 @@ async def session_timer_task(phone: str, duration: int, transaction_id: str, is_
     # Time Ended - Cleanup
     try:
         msg = f"Your session time of {duration} minutes has ended. Please proceed to exit."
-        await loop.run_in_executor(None, whatsapp_service.send_message, phone, msg)
+        await whatsapp_service.asend_message(phone, msg)
         log_debug(f"Sent ended message to {phone}")
         
         # Remove from active sessions
         if transaction_id in active_sessions:
-            del active_sessions[transaction_id]
-            save_sessions()
+            session = active_sessions.pop(transaction_id)
+            untrack_session_end(transaction_id, session["end_time"])
+            delete_one_session(transaction_id)
             log_debug(f"Session {transaction_id} expired and removed.")
             
     except Exception as e:
@@ -1,15 +1,39 @@
 import os
-import json
+import time
+import logging
+import functools
+import struct
+import secrets
+import orjson
 import base64
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from typing import Dict, Any
 
+logger = logging.getLogger(__name__)
+
 KEY_FILE = "secret.key"
+# Fernet tokens start with the version byte 0x80, which base64-encodes to "gA"
+FERNET_TOKEN_PREFIX = b"gA"
+FERNET_VERSION = 0x80
+# Version byte + 64-bit timestamp + 128-bit IV, and a trailing SHA256 HMAC
+HEADER_SIZE = 1 + 8 + 16
+HMAC_SIZE = 32
+DECRYPT_CACHE_SIZE = 4096
 
 class CryptoService:
     def __init__(self):
         self.key = self._load_key()
-        self.cipher_suite = Fernet(self.key)
+        # Split the Fernet key once instead of on every call
+        raw_key = base64.urlsafe_b64decode(self.key)
+        if len(raw_key) != 32:
+            raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes")
+        self._signing_key = raw_key[:16]
+        self._encryption_key = raw_key[16:]
+        self._hmac = hmac.HMAC(self._signing_key, hashes.SHA256())
+        # Repeat scans of the same QR code skip the crypto entirely; failures are never cached
+        self._decrypt_cached = functools.lru_cache(maxsize=DECRYPT_CACHE_SIZE)(self._decrypt_token)
 
     def _load_key(self):
         """
@@ -26,22 +50,48 @@ class CryptoService:
 
     def encrypt(self, data: Dict[str, Any]) -> str:
         """
-        Encrypts a dictionary into a token string.
+        Encrypts a dictionary into a token string (Fernet token format).
         """
-        json_str = json.dumps(data)
-        encrypted_bytes = self.cipher_suite.encrypt(json_str.encode())
-        return base64.urlsafe_b64encode(encrypted_bytes).decode()
+        iv = secrets.token_bytes(16)
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded = padder.update(orjson.dumps(data)) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(self._encryption_key), modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(padded) + encryptor.finalize()
+
+        basic_parts = struct.pack(">BQ", FERNET_VERSION, int(time.time())) + iv + ciphertext
+        h = self._hmac.copy()
+        h.update(basic_parts)
+        return base64.urlsafe_b64encode(basic_parts + h.finalize()).decode("ascii")
 
     def decrypt(self, token: str) -> Dict[str, Any]:
         """
         Decrypts a token string back into a dictionary.
         """
         try:
-            encrypted_bytes = base64.urlsafe_b64decode(token.encode())
-            decrypted_bytes = self.cipher_suite.decrypt(encrypted_bytes)
-            return json.loads(decrypted_bytes.decode())
+            # Copy so callers cannot modify the cached result
+            return dict(self._decrypt_cached(token))
         except Exception as e:
-            print(f"Decryption error: {e}")
+            logger.warning("Decryption error: %s", e)
             raise ValueError("Invalid token")
 
+    def _decrypt_token(self, token: str) -> Dict[str, Any]:
+        encrypted_bytes = token.encode("ascii")
+        # Tokens issued before the outer base64 layer was dropped are still accepted
+        if not encrypted_bytes.startswith(FERNET_TOKEN_PREFIX):
+            encrypted_bytes = base64.urlsafe_b64decode(encrypted_bytes)
+        token_bytes = base64.urlsafe_b64decode(encrypted_bytes)
+        if len(token_bytes) < HEADER_SIZE + HMAC_SIZE or token_bytes[0] != FERNET_VERSION:
+            raise ValueError("Malformed token")
+
+        h = self._hmac.copy()
+        h.update(token_bytes[:-HMAC_SIZE])
+        h.verify(token_bytes[-HMAC_SIZE:])
+
+        iv = token_bytes[9:HEADER_SIZE]
+        decryptor = Cipher(algorithms.AES(self._encryption_key), modes.CBC(iv)).decryptor()
+        padded = decryptor.update(token_bytes[HEADER_SIZE:-HMAC_SIZE]) + decryptor.finalize()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        decrypted_bytes = unpadder.update(padded) + unpadder.finalize()
+        return orjson.loads(decrypted_bytes)
+
 crypto_service = CryptoService()
@@ -1,13 +1,69 @@
 import gspread
 import os
+import logging
+import re
+import time
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict
+from itertools import zip_longest
+from typing import List, Dict, Tuple
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+# How long a looked-up entry status is reused before asking the sheet again
+STATUS_CACHE_TTL_SECONDS = 60
+STATUS_CACHE_SIZE = 4096
+# How long a snapshot of the Transaction ID column is trusted before it is downloaded again
+TXID_CACHE_TTL_SECONDS = 30
+# How long the downloaded stats columns are reused by the stats methods
+STATS_CACHE_TTL_SECONDS = 15
+# Appended rows are buffered and sent together after this delay, or immediately once the batch is full
+APPEND_FLUSH_SECONDS = 1.0
+APPEND_BATCH_SIZE = 50
+# Upper bound on waiting for another thread's append before looking up a row
+APPEND_WAIT_TIMEOUT_SECONDS = 30
+# Transaction ID is in Column 4 (D), Status is in Column 7 (G)
+TXID_COLUMN = "D"
+STATUS_COLUMN = "G"
+# First row number of an A1 range such as "Sheet1!A5:I7"
+_RANGE_START_ROW = re.compile(r"![A-Z]+(\d+)")
+# Amount cells may carry a currency prefix (₹, Rs, INR) and thousands separators around the number
+_AMOUNT = re.compile(
+    r"\s*(?:₹|Rs\.?|INR)?\s*(-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)\s*",
+    re.IGNORECASE,
+)
+
 class GoogleSheetService:
     def __init__(self, credentials_path: str = "credentials.json"):
         self.credentials_path = credentials_path
         self.client = None
+        # Snapshot of the stripped Transaction ID column as transaction_id -> row number
+        # (None while the row number is unknown), kept current with our own appends
+        self._txid_cache = None
+        self._txid_cache_ts = 0.0
+        # While a column download is running, IDs appended meanwhile are also recorded here
+        # so the new snapshot cannot miss them
+        self._txid_refreshing = 0
+        self._txid_recent = {}
+        # transaction_id -> (expires_at, status), oldest first
+        self._status_cache = OrderedDict()
+        self._status_lock = threading.Lock()
+        # sheet_url -> (fetched_at, (timestamp, amount) pairs without header)
+        self._rows_cache = {}
+        # sheet_url -> opened first worksheet, reused until the client is re-authorized
+        self._worksheets = {}
+        # sheet_url -> rows waiting to be appended
+        self._pending_rows = {}
+        # (sheet_url, rows) batches taken out of _pending_rows whose append request has not finished yet
+        self._inflight_rows = []
+        # sheet_url -> consecutive failed append attempts
+        self._append_failures = {}
+        self._append_lock = threading.Lock()
+        # Notified whenever an in-flight batch finishes
+        self._append_done = threading.Condition(self._append_lock)
+        self._flush_timer = None
 
     def connect(self):
         if not os.path.exists(self.credentials_path):
@@ -56,65 +112,255 @@ class GoogleSheetService:
                     token.write(creds.to_json())
             
             self.client = gspread.authorize(creds)
+            self._worksheets.clear()
             
         except Exception as e:
-            print(f"Failed to authenticate with Google Sheets: {e}")
+            logger.error("Failed to authenticate with Google Sheets: %s", e)
             raise e
 
+    def _worksheet(self, sheet_url: str):
+        """
+        Returns the first worksheet of the sheet, opening it only on first use.
+        """
+        worksheet = self._worksheets.get(sheet_url)
+        if worksheet is None:
+            if not self.client:
+                self.connect()
+            worksheet = self.client.open_by_url(sheet_url).get_worksheet(0) # Assume first worksheet
+            self._worksheets[sheet_url] = worksheet
+        return worksheet
+
+    def _reset_on_auth_error(self, error: Exception):
+        """Drops the client and cached worksheets when Google rejects our credentials."""
+        if isinstance(error, gspread.exceptions.APIError) and error.response.status_code in (401, 403):
+            self.client = None
+            self._worksheets.clear()
+
     def append_data(self, sheet_url: str, data: List[str]):
         """
-        Appends a row of data to the specified Google Sheet.
+        Queues a row of data for the specified Google Sheet.
+        Rows are written in batches by flush_appends.
         """
-        if not self.client:
-            self.connect()
-        
+        with self._append_lock:
+            pending = self._pending_rows.setdefault(sheet_url, [])
+            pending.append(data)
+            # Row order: Timestamp, Name, Phone, Transaction ID, ...
+            if self._txid_cache is not None:
+                self._txid_cache.setdefault(str(data[3]).strip(), None)
+            flush_now = len(pending) >= APPEND_BATCH_SIZE
+            if not flush_now:
+                self._arm_flush_timer(APPEND_FLUSH_SECONDS)
+
+        if flush_now:
+            self.flush_appends()
+
+    def append_data_now(self, sheet_url: str, data: List[str]):
+        """
+        Appends a row of data to the specified Google Sheet immediately.
+        """
+        self._append_rows(sheet_url, [data])
+
+    def flush_appends(self):
+        """
+        Writes all queued rows, one append request per sheet. Failed rows are retried later,
+        up to settings.MAX_RETRIES times; rows the API rejects outright are dropped and logged.
+        """
+        with self._append_lock:
+            pending = self._pending_rows
+            self._pending_rows = {}
+            self._inflight_rows.extend(pending.items())
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        for sheet_url, rows in pending.items():
+            try:
+                self._append_rows(sheet_url, rows)
+            except Exception as e:
+                with self._append_lock:
+                    failures = self._append_failures.get(sheet_url, 0) + 1
+                    if self._is_rejected(e) or failures > settings.MAX_RETRIES:
+                        self._append_failures.pop(sheet_url, None)
+                        logger.error("Dropping %d row(s) for sheet after %d attempt(s): %s", len(rows), failures, rows)
+                        # Never written, so the IDs may be submitted again
+                        if self._txid_cache is not None:
+                            for row in rows:
+                                tid = str(row[3]).strip()
+                                if self._txid_cache.get(tid, 0) is None:
+                                    del self._txid_cache[tid]
+                    else:
+                        self._append_failures[sheet_url] = failures
+                        # Put them back in front of anything queued meanwhile
+                        self._pending_rows[sheet_url] = rows + self._pending_rows.get(sheet_url, [])
+                        self._arm_flush_timer(settings.RETRY_DELAY_SECONDS)
+            else:
+                with self._append_lock:
+                    self._append_failures.pop(sheet_url, None)
+            finally:
+                with self._append_lock:
+                    self._inflight_rows.remove((sheet_url, rows))
+                    self._append_done.notify_all()
+
+    def _wait_for_appends(self, sheet_url: str):
+        """
+        Writes any buffered rows and waits for appends already in progress on other threads,
+        so a row submitted moments ago can be found in the sheet.
+        """
+        if self._pending_rows:
+            self.flush_appends()
+        with self._append_done:
+            finished = self._append_done.wait_for(
+                lambda: all(url != sheet_url for url, _ in self._inflight_rows),
+                timeout=APPEND_WAIT_TIMEOUT_SECONDS,
+            )
+        if not finished:
+            logger.warning("Timed out waiting for pending appends to %s", sheet_url)
+
+    @staticmethod
+    def _is_rejected(error: Exception) -> bool:
+        """True for client errors that retrying the same rows cannot fix (auth and rate limits excluded)."""
+        if not isinstance(error, gspread.exceptions.APIError):
+            return False
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (401, 403, 429)
+
+    def _arm_flush_timer(self, delay: float):
+        # Caller must hold self._append_lock
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(delay, self.flush_appends)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _append_rows(self, sheet_url: str, rows: List[List[str]]):
         try:
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0) # Assume first worksheet
-            worksheet.append_row(data)
-            print(f"Successfully appended data to sheet: {data}")
+            worksheet = self._worksheet(sheet_url)
+            response = worksheet.append_rows(rows)
+            first_row = self._first_appended_row(response)
+            with self._append_lock:
+                for offset, row in enumerate(rows):
+                    tid = str(row[3]).strip()
+                    row_number = first_row + offset if first_row else None
+                    if self._txid_cache is not None:
+                        self._txid_cache[tid] = row_number
+                    if self._txid_refreshing:
+                        self._txid_recent[tid] = row_number
+            self._rows_cache.pop(sheet_url, None)
+            logger.info("Successfully appended %d row(s) to sheet: %s", len(rows), rows)
         except Exception as e:
-            import traceback
-            print(f"Error appending data to sheet: {traceback.format_exc()}")
-            # Optional: Retry logic or re-auth could go here
+            self._reset_on_auth_error(e)
+            logger.exception("Error appending data to sheet")
             raise e
 
     def fetch_data(self, sheet_url: str) -> List[Dict]:
-        if not self.client:
-            self.connect()
-        
         try:
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0) # Assume first worksheet
+            worksheet = self._worksheet(sheet_url)
             records = worksheet.get_all_records()
             return records
         except Exception as e:
-            print(f"Error fetching data: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error fetching data: %s", e)
             raise e
 
     
-    def check_transaction_exists(self, sheet_url: str, transaction_id: str) -> bool:
+    @staticmethod
+    def _first_appended_row(response):
+        try:
+            match = _RANGE_START_ROW.search(response["updates"]["updatedRange"])
+            return int(match.group(1)) if match else None
+        except (KeyError, TypeError):
+            return None
+
+    def _transaction_rows(self, sheet_url: str) -> Dict[str, int]:
         """
-        Checks if a transaction ID already exists in the sheet.
-        Assumes Transaction ID is in Column 4 (D).
+        Returns transaction_id -> row number for the Transaction ID column (D),
+        downloading the column at most once per TXID_CACHE_TTL_SECONDS.
         """
-        if not self.client:
-            self.connect()
-            
+        if self._txid_cache is not None and time.monotonic() - self._txid_cache_ts < TXID_CACHE_TTL_SECONDS:
+            return self._txid_cache
+
+        worksheet = self._worksheet(sheet_url)
+
+        with self._append_lock:
+            self._txid_refreshing += 1
         try:
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0)
-            
             # Get all values in column 4 (Transaction IDs)
             # col_values(4) returns a list of strings
             transaction_ids = worksheet.col_values(4)
-            
-            # Check if exists (case-sensitive or insensitive? Let's go with exact match for IDs usually)
-            # You might want to strip whitespace just in case
-            return transaction_id.strip() in [tid.strip() for tid in transaction_ids]
+        except Exception:
+            with self._append_lock:
+                self._finish_txid_refresh()
+            raise
+
+        # Exact match for IDs, ignoring surrounding whitespace. The first occurrence wins.
+        txid_rows = {}
+        for row_number, tid in enumerate(transaction_ids, start=1):
+            txid_rows.setdefault(tid.strip(), row_number)
+        with self._append_lock:
+            # Rows appended while the column was downloading may be missing from it
+            for tid, row_number in self._txid_recent.items():
+                if txid_rows.get(tid) is None:
+                    txid_rows[tid] = row_number
+            batches = [rows for _, rows in self._inflight_rows] + list(self._pending_rows.values())
+            for rows in batches:
+                for row in rows:
+                    txid_rows.setdefault(str(row[3]).strip(), None)
+            self._txid_cache = txid_rows
+            self._txid_cache_ts = time.monotonic()
+            self._finish_txid_refresh()
+        return txid_rows
+
+    def _finish_txid_refresh(self):
+        # Caller must hold self._append_lock
+        self._txid_refreshing -= 1
+        if not self._txid_refreshing:
+            self._txid_recent.clear()
+
+    def _find_row(self, worksheet, sheet_url: str, transaction_id: str, column: str = None):
+        """
+        Returns (row number, value of `column` in that row) for a transaction ID, or (None, None)
+        if it is not in the sheet. A cached row number is only used after confirming, in the same
+        request, that the row still holds the ID: rows may have been sorted, inserted or deleted
+        since the column snapshot was taken.
+        """
+        target = transaction_id.strip()
+        txid_rows = self._transaction_rows(sheet_url)
+        if target not in txid_rows:
+            return None, None
+
+        row = txid_rows[target]
+        if row is not None:
+            ranges = [f"{TXID_COLUMN}{row}"]
+            if column:
+                ranges.append(f"{column}{row}")
+            values = [self._cell_value(value_range) for value_range in worksheet.batch_get(ranges)]
+            if values[0].strip() == target:
+                return row, values[1] if column else None
+
+        # Appended without a known row number, or moved since the snapshot; fall back to a search
+        cell = worksheet.find(transaction_id)
+        if not cell:
+            return None, None
+        txid_rows[target] = cell.row
+        value = worksheet.acell(f"{column}{cell.row}").value if column else None
+        return cell.row, value
+
+    @staticmethod
+    def _cell_value(value_range) -> str:
+        # Empty cells come back as empty lists
+        return value_range[0][0] if value_range and value_range[0] else ""
+
+    def check_transaction_exists(self, sheet_url: str, transaction_id: str) -> bool:
+        """
+        Checks if a transaction ID already exists in the sheet.
+        Assumes Transaction ID is in Column 4 (D).
+        The column is downloaded at most once per TXID_CACHE_TTL_SECONDS; lookups are dict probes.
+        """
+        try:
+            return transaction_id.strip() in self._transaction_rows(sheet_url)
             
         except Exception as e:
-            print(f"Error checking transaction existence: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error checking transaction existence: %s", e)
             # Fail safe: if we can't check, maybe we should assume false or raise error?
             # Let's log and return False to allow entry but warn, or raise? 
             # Safer to block if DB is down? Or allow? 
@@ -125,158 +371,138 @@ class GoogleSheetService:
     def update_entry_status(self, transaction_id: str, new_status: str):
         """
         Updates the status of a specific entry based on Transaction ID.
-        Assumes Transaction ID is in Column 4 (D) and Status is in Column 5 (E).
+        Assumes Transaction ID is in Column 4 (D) and Status is in Column 7 (G).
         """
-        if not self.client:
-            self.connect()
-        
         try:
             sheet_url = settings.SHEET_URL
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0)
+            # The row may still be buffered or being appended
+            self._wait_for_appends(sheet_url)
+            worksheet = self._worksheet(sheet_url)
             
-            # Find the cell with the transaction ID
-            cell = worksheet.find(transaction_id)
+            row, _ = self._find_row(worksheet, sheet_url, transaction_id)
             
-            if cell:
-                # Update the cell in the next column (Column 5/E if ID is in 4/D)
-                # Adjusting logic: logic says ID is 4th item in list -> Col 4. Status -> Col 5.
-                # cell.row is the row number. cell.col should be 4.
-                # We want to update (cell.row, 5).
-                
-                # Check if we are really in column 4? 
-                # Ideally, we trust the caller or just search. 
-                # If ID is unique, finding it is enough.
-                
-                # Update the cell to the right (assuming status is next to it)
-                # Or hardcode column 5 if we are sure structure is fixed.
-                # Let's hardcode column 5 (E) for Status as per plan.
-                # Status is in Column 7 (G)
-                worksheet.update_cell(cell.row, 7, new_status)
-                print(f"Updated status for {transaction_id} to {new_status}")
+            if row:
+                worksheet.update_acell(f"{STATUS_COLUMN}{row}", new_status)
+                self._cache_status(transaction_id, new_status)
+                logger.info("Updated status for %s to %s", transaction_id, new_status)
                 return True
             else:
-                print(f"Transaction ID {transaction_id} not found.")
+                logger.warning("Transaction ID %s not found.", transaction_id)
                 return False
                 
         except Exception as e:
-            print(f"Error updating status: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error updating status: %s", e)
             return False
     
+    def _get_stats_rows(self, sheet_url: str) -> List[Tuple[str, str]]:
+        """
+        Returns (timestamp, amount) for every data row (header skipped). Only columns A and E
+        are downloaded, in one request, at most once per STATS_CACHE_TTL_SECONDS.
+        """
+        cached = self._rows_cache.get(sheet_url)
+        if cached and time.monotonic() - cached[0] < STATS_CACHE_TTL_SECONDS:
+            return cached[1]
+
+        worksheet = self._worksheet(sheet_url)
+        # Timestamp (A) and Amount (E); empty cells come back as empty lists
+        timestamps, amounts = worksheet.batch_get(["A:A", "E:E"])
+        rows = [
+            (ts[0] if ts else "", amount[0] if amount else "")
+            for ts, amount in zip_longest(timestamps, amounts, fillvalue=[])
+        ]
+
+        # Assume header is row 0, data starts row 1
+        # But let's check content. If row 0 starts with "Timestamp", skip it.
+        start_idx = 1 if rows and rows[0][0] == "Timestamp" else 0
+        data_rows = rows[start_idx:]
+
+        self._rows_cache[sheet_url] = (time.monotonic(), data_rows)
+        return data_rows
+
+    @staticmethod
+    def _parse_amount(amount_str) -> float:
+        # Only known decorations are accepted; anything else counts as 0
+        match = _AMOUNT.fullmatch(str(amount_str).replace(",", ""))
+        return float(match.group(1)) if match else 0.0
+
     def get_stats_for_today(self, sheet_url: str):
         """Calculates total entries and amount for the current day."""
-        if not self.client:
-            self.connect()
-
         try:
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0)
-            
-            # 1. Get all values
-            rows = worksheet.get_all_values()
-            
-            # Skip header if exists (simple check)
-            if not rows:
-                return {"count": 0, "total": 0}
-            
-            # Assume header is row 0, data starts row 1
-            # But let's check content. If row 0 has "Timestamp", skip it.
-            start_idx = 1 if rows and "Timestamp" in rows[0] else 0
-            
-            data_rows = rows[start_idx:]
-            
+            data_rows = self._get_stats_rows(sheet_url)
             today_str = datetime.now().strftime("%Y-%m-%d")
             
             count = 0
-            total_amount = 0
+            total_amount = 0.0
             
-            for row in data_rows:
-                # Row structure: [Timestamp, Name, Phone, TxID, Amount, Duration, Status]
-                if len(row) < 5:
-                    continue
-                    
-                timestamp = row[0]
-                amount_str = row[4]
-                
+            for timestamp, amount_str in data_rows:
                 if timestamp.startswith(today_str):
                     count += 1
-                    try:
-                        total_amount += float(amount_str)
-                    except ValueError:
-                        pass
+                    total_amount += self._parse_amount(amount_str)
                         
             return {"count": count, "total": int(total_amount)}
             
         except Exception as e:
-            print(f"Error calculating stats: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error calculating stats: %s", e)
             return {"count": 0, "total": 0}
     
     def get_total_stats(self, sheet_url: str):
         """Calculates all-time total entries and amount."""
-        if not self.client:
-            self.connect()
-
         try:
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0)
-            
-            # 1. Get all values
-            rows = worksheet.get_all_values()
-            
-            if not rows:
-                return {"count": 0, "total": 0}
-            
-            # Skip header
-            start_idx = 1 if rows and "Timestamp" in rows[0] else 0
-            data_rows = rows[start_idx:]
+            data_rows = self._get_stats_rows(sheet_url)
             
             count = 0
             total_amount = 0.0
             
-            for row in data_rows:
-                # Row structure: [Timestamp, Name, Phone, TxID, Amount, Duration, Status]
-                if len(row) < 5:
-                    continue
-                
+            for _, amount_str in data_rows:
                 # Count every row as a participant
                 count += 1
-                
-                # Sum Amount
-                amount_str = row[4]
-                try:
-                    # Remove potential currency symbols or commas if any
-                    clean_amount = str(amount_str).replace(",", "").replace("₹", "").strip()
-                    if clean_amount:
-                        total_amount += float(clean_amount)
-                except ValueError:
-                    pass
+                total_amount += self._parse_amount(amount_str)
                         
             return {"count": count, "total": int(total_amount)}
             
         except Exception as e:
-            print(f"Error calculating total stats: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error calculating total stats: %s", e)
             return {"count": 0, "total": 0}
 
+    def _cache_status(self, transaction_id: str, status: str):
+        """Remembers a status for STATUS_CACHE_TTL_SECONDS, keeping at most STATUS_CACHE_SIZE entries."""
+        now = time.monotonic()
+        with self._status_lock:
+            self._status_cache[transaction_id] = (now + STATUS_CACHE_TTL_SECONDS, status)
+            self._status_cache.move_to_end(transaction_id)
+            # Every entry has the same TTL, so the oldest entries expire first
+            while self._status_cache:
+                expires_at, _ = next(iter(self._status_cache.values()))
+                if expires_at > now and len(self._status_cache) <= STATUS_CACHE_SIZE:
+                    break
+                self._status_cache.popitem(last=False)
+
     def get_entry_status(self, transaction_id: str) -> str:
         """
         Gets the current status of a transaction ID.
-        Assumes Transaction ID is in Column 4 (D) and Status is in Column 5 (E).
+        Assumes Transaction ID is in Column 4 (D) and Status is in Column 7 (G).
+        Recently seen statuses are served from memory.
         """
-        if not self.client:
-            self.connect()
-            
+        cached = self._status_cache.get(transaction_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
         try:
             sheet_url = settings.SHEET_URL
-            sheet = self.client.open_by_url(sheet_url)
-            worksheet = sheet.get_worksheet(0)
+            # The row may still be buffered or being appended
+            self._wait_for_appends(sheet_url)
+            worksheet = self._worksheet(sheet_url)
             
-            cell = worksheet.find(transaction_id)
-            if cell:
-                # Get status from column 5 (E)
-                status = worksheet.cell(cell.row, 5).value
+            row, status = self._find_row(worksheet, sheet_url, transaction_id, STATUS_COLUMN)
+            if row:
+                self._cache_status(transaction_id, status)
                 return status
             return None
             
         except Exception as e:
-            print(f"Error getting status: {e}")
+            self._reset_on_auth_error(e)
+            logger.error("Error getting status: %s", e)
             return None
@@ -1,6 +1,7 @@
-import qrcode
+import segno
 import os
 import uuid
+import hashlib
 
 class QRGenerator:
     def __init__(self, output_dir: str = "generated_qrs"):
@@ -12,21 +13,27 @@ class QRGenerator:
         """
         Generates a QR code for the given data and saves it to the output directory.
         Returns the absolute path of the generated image.
+        Images are named after a hash of the data, so repeated payloads reuse the existing file.
         """
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Create a unique filename
-        filename = f"{uuid.uuid4()}.png"
+        # Content-addressed filename
+        filename = f"{hashlib.sha1(data.encode('utf-8')).hexdigest()}.png"
         filepath = os.path.join(self.output_dir, filename)
-        
-        img.save(filepath)
+        if os.path.exists(filepath):
+            return os.path.abspath(filepath)
+
+        qr = segno.make_qr(data, error="l")
+
+        # Write under a temporary name first so a concurrent request never sees a partial image.
+        # Fast zlib level: a two-colour QR barely compresses further at higher levels.
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            qr.save(tmp_path, kind="png", scale=10, border=4, compresslevel=1)
+            os.replace(tmp_path, filepath)
+        except Exception:
+            # The output directory is served publicly; never leave partial files behind
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
         return os.path.abspath(filepath)
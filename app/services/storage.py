@@ -0,0 +1,142 @@
+import logging
+import os
+import orjson
+import queue
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Large enough that a record is written with a single write() call
+WRITE_BUFFER_SIZE = 1 << 16
+# Operations queued within this window are coalesced into one pass
+DEBOUNCE_SECONDS = 0.1
+
+def record_path(directory: str, record_id: str) -> str:
+    """
+    Returns the file path for a record, escaping the ID so it is always a safe filename.
+    """
+    return os.path.join(directory, quote(record_id, safe="") + ".json")
+
+def write_json_atomic(path: str, data: Dict[str, Any]):
+    """
+    Writes a JSON document via a temp file in the same directory and renames it into place,
+    so readers only ever see the old or the new file, never a partial write.
+    """
+    write_bytes_atomic(path, orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def write_bytes_atomic(path: str, payload: bytes):
+    """Atomically replaces a file with the given bytes."""
+    # Bare filenames (e.g. the server state file) live in the working directory
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    else:
+        directory = "."
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json.tmp")
+    try:
+        with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def delete_file(path: str):
+    """Removes a record file, ignoring records that were never written."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def load_json_dir(directory: str) -> List[Dict[str, Any]]:
+    """
+    Loads every JSON record in a directory. Unreadable records are skipped.
+    """
+    records = []
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return records
+
+    with entries:
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    records.append(orjson.loads(f.read()))
+            except Exception as e:
+                logger.warning("Skipping unreadable record %s: %s", entry.path, e)
+    return records
+
+class FileWriter:
+    """
+    Performs disk writes on a single background thread so request handlers never block on I/O.
+    Bursts are debounced: only the last write/delete per file is applied.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def write_json(self, path: str, data: Dict[str, Any]):
+        """Queues an atomic JSON write. The data is serialized immediately."""
+        self._put(("write", path, orjson.dumps(data, option=orjson.OPT_INDENT_2)))
+
+    def delete(self, path: str):
+        """Queues a file deletion."""
+        self._put(("delete", path, None))
+
+    def flush(self):
+        """Blocks until every queued operation has been written."""
+        if self.thread is not None:
+            self.queue.join()
+
+    def _put(self, item):
+        if self.thread is None:
+            with self._lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="file-writer", daemon=True)
+                    self.thread.start()
+        self.queue.put_nowait(item)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + DEBOUNCE_SECONDS
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            latest = {}
+            for op, path, payload in batch:
+                latest[path] = (op, payload)
+
+            for path, (op, payload) in latest.items():
+                try:
+                    if op == "write":
+                        write_bytes_atomic(path, payload)
+                    elif op == "delete":
+                        delete_file(path)
+                except Exception as e:
+                    logger.error("File writer failed to %s %s: %s", op, path, e)
+
+            for _ in batch:
+                self.queue.task_done()
+
+file_writer = FileWriter()
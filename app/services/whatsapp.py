@@ -1,115 +1,146 @@
 import os
 import threading
 import time
+import random
+import asyncio
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
 from neonize.client import NewClient
 from neonize.events import ConnectedEv, PairStatusEv, Event
 from neonize.utils import log
 from neonize.utils.jid import build_jid
 from neonize.proto.Neonize_pb2 import Message
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from app.config import settings
 
+# Sends block on the neonize client, so they run on a dedicated, bounded set of threads
+SEND_WORKERS = 8
+
+# Reconnect delays double from the minimum up to the maximum (plus up to 50% jitter).
+# A connection that stays up this long resets the delay to the minimum.
+RECONNECT_BACKOFF_MIN_SECONDS = 0.5
+RECONNECT_BACKOFF_MAX_SECONDS = 60
+STABLE_CONNECTION_SECONDS = 30
+# How long a send waits for the client to (re)connect
+CONNECT_TIMEOUT_SECONDS = 15
+
+# Characters dropped from phone numbers before building a JID
+_PHONE_TABLE = str.maketrans("", "", "+ -\t\r\n")
+
+def _normalize_phone(phone_number: str) -> str:
+    phone_number = phone_number.translate(_PHONE_TABLE)
+    # Add default country code if missing (assuming IN +91 for 10-digit numbers)
+    if len(phone_number) == 10:
+        phone_number = "91" + phone_number
+    return phone_number
+
 class WhatsAppService:
     def __init__(self, session_name: str = None):
         if session_name is None:
             session_name = settings.WHATSAPP_SESSION_NAME
         self.session_name = session_name
         self.client = NewClient(session_name + ".sqlite3")
-        self.is_connected = False
+        self._connected_event = threading.Event()
+        self._connected_at = None
         self.qr_callback = None
+        self._executor = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="wa-send")
         
         # Setup event listeners
         @self.client.event(ConnectedEv)
         def on_connected(client, event: ConnectedEv):
-            from app.config import log_debug
-            log_debug("WhatsApp Connected")
-            self.is_connected = True
+            logger.info("WhatsApp Connected")
+            self._connected_event.set()
+            self._connected_at = time.monotonic()
 
         @self.client.event(PairStatusEv)
         def on_pair_status(client, event: PairStatusEv):
-            from app.config import log_debug
-            log_debug(f"Pair Status: {event}")
+            logger.info("Pair Status: %s", event)
 
     def start(self):
         """Starts the neonize client in a separate thread."""
         def run_client():
-            from app.config import log_debug
-            log_debug("Starting WhatsApp Client Thread...")
+            logger.info("Starting WhatsApp Client Thread...")
             
+            backoff = RECONNECT_BACKOFF_MIN_SECONDS
             while True:
                 try:
                     # self.client.connect() DOES BLOCK, so we should just call it.
                     # If it returns or errors, we restart.
                     self.client.connect()
                 except Exception as e:
-                    log_debug(f"WhatsApp client disconnected/error: {e}. Reconnecting in 5s...")
-                    self.is_connected = False
-                    time.sleep(5)
+                    if self._connected_at is not None and time.monotonic() - self._connected_at >= STABLE_CONNECTION_SECONDS:
+                        backoff = RECONNECT_BACKOFF_MIN_SECONDS
+                    self._connected_at = None
+                    self._connected_event.clear()
+
+                    delay = backoff + random.uniform(0, backoff / 2)
+                    logger.warning("WhatsApp client disconnected/error: %s. Reconnecting in %.1fs...", e, delay)
+                    time.sleep(delay)
+                    backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_SECONDS)
 
         self.thread = threading.Thread(target=run_client, daemon=True)
         self.thread.start()
         
+    @property
+    def is_connected(self) -> bool:
+        return self._connected_event.is_set()
+
     def ensure_connection(self):
         """Waits for connection with timeout."""
         if self.is_connected:
             return True
             
-        from app.config import log_debug
-        log_debug("Waiting for WhatsApp connection...")
+        logger.debug("Waiting for WhatsApp connection...")
         
-        # Wait up to 15 seconds
-        for _ in range(30):
-            if self.is_connected:
-                log_debug("WhatsApp connected successfully.")
-                return True
-            time.sleep(0.5)
+        # Wait up to 15 seconds, waking as soon as the client connects
+        if self._connected_event.wait(CONNECT_TIMEOUT_SECONDS):
+            logger.debug("WhatsApp connected successfully.")
+            return True
             
         # Try to reconnect manually if stuck
-        log_debug("Connection timed out. Checking thread status...")
+        logger.warning("Connection timed out. Checking thread status...")
         if not self.thread.is_alive():
-            log_debug("Thread died, restarting...")
+            logger.warning("Thread died, restarting...")
             self.start()
             
         return False
 
-    def send_image(self, phone_number: str, image_path: str, caption: str = ""):
+    def send_image(self, phone_number: str, image_path: str, caption: str = "") -> Future:
+        """
+        Queues an image for the specified phone number and returns immediately.
+        The returned Future resolves to True if the image was sent.
+        """
+        return self._executor.submit(self._send_image_blocking, phone_number, image_path, caption)
+
+    def _send_image_blocking(self, phone_number: str, image_path: str, caption: str = ""):
         """
         Sends an image to the specified phone number.
         phone_number should be in format '1234567890' (no + or @s.whatsapp.net, we will clean it).
         """
-        from app.config import log_debug
-        
         if not self.ensure_connection():
-            log_debug("WhatsApp client not connected. Attempting to send anyway, might fail or queue.")
+            logger.warning("WhatsApp client not connected. Attempting to send anyway, might fail or queue.")
 
-        phone_number = phone_number.strip().replace("+", "").replace(" ", "").replace("-", "")
-        
-        # Add default country code if missing (assuming IN +91 for 10-digit numbers)
-        if len(phone_number) == 10:
-            phone_number = "91" + phone_number
+        phone_number = _normalize_phone(phone_number)
             
         # Build JID
         try:
             jid = build_jid(phone_number, "s.whatsapp.net")
-            log_debug(f"DEBUG: Generated JID object: {jid} (Type: {type(jid)})")
+            logger.debug("Generated JID object: %s (Type: %s)", jid, type(jid))
         except Exception as e:
-            log_debug(f"ERROR: Failed to build JID: {e}")
+            logger.error("Failed to build JID: %s", e)
             return False
 
         try:
-            log_debug(f"DEBUG: Attempting to send image to {jid} from {image_path}")
+            logger.debug("Attempting to send image to %s from %s", jid, image_path)
             
             # Check if file exists
             if not os.path.exists(image_path):
-                log_debug(f"ERROR: Image file not found at {image_path}")
+                logger.error("Image file not found at %s", image_path)
                 return False
 
-            log_debug(f"Sending image to {jid} from {image_path}")
+            logger.info("Sending image to %s from %s", jid, image_path)
             self.client.send_image(
                 to=jid,
                 file=image_path,
@@ -117,21 +148,17 @@ class WhatsAppService:
             )
             return True
         except Exception as e:
-            log_debug(f"Failed to send image: {e}")
+            logger.error("Failed to send image: %s", e)
             return False
 
     def send_message(self, phone_number: str, message: str):
         """
         Sends a text message to the specified phone number.
         """
-        from app.config import log_debug
-        
         if not self.ensure_connection():
-            log_debug("WhatsApp client not connected. Attempting to send anyway.")
+            logger.warning("WhatsApp client not connected. Attempting to send anyway.")
 
-        phone_number = phone_number.strip().replace("+", "").replace(" ", "").replace("-", "")
-        if len(phone_number) == 10:
-            phone_number = "91" + phone_number
+        phone_number = _normalize_phone(phone_number)
 
         try:
             from neonize.proto.waE2E.WAWebProtobufsE2E_pb2 import Message
@@ -144,16 +171,18 @@ class WhatsAppService:
                 to=jid,
                 message=msg
             )
-            logger.info(f"Sent message to {phone_number}: {message}")
+            logger.info("Sent message to %s: %s", phone_number, message)
             return True
         except Exception as e:
-            logger.error(f"Failed to send message: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Failed to send message: %s", e)
             return False
 
-# Global instance
-whatsapp_service = WhatsAppService()
+    async def asend_message(self, phone_number: str, message: str):
+        """
+        Sends a text message without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.send_message, phone_number, message)
 
 # Global instance
 whatsapp_service = WhatsAppService()
@@ -11,12 +11,18 @@ if __name__ == "__main__":
     
     import socket
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
+        # Time-boxed so a host without outbound networking does not delay startup
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(0.3)
+            s.connect(("8.8.8.8", 80))
+            local_ip = s.getsockname()[0]
         print(f"\n✅ Server is running! Access it at: http://{local_ip}:5000\n")
-    except Exception:
+    except OSError:
         print("\nCould not determine local IP. Try accessing via http://localhost:5000\n")
 
-    uvicorn.run("app.main:app", host="0.0.0.0", port=5000, reload=True)
+    if os.getenv("ENV") == "prod":
+        # No file-watcher reloader in production. A single worker on purpose: sessions, timers and
+        # the WhatsApp client live in process memory. "auto" picks uvloop and httptools when installed.
+        uvicorn.run("app.main:app", host="0.0.0.0", port=5000, loop="auto", http="auto", log_level="warning")
+    else:
+        uvicorn.run("app.main:app", host="0.0.0.0", port=5000, reload=True)